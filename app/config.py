@@ -10,10 +10,12 @@ DEFAULT_CONFIGS = {
     "DEFAULT_RESPONSE_FORMAT": 'mp3',
     "DEFAULT_SPEED": 1.0,
     "DEFAULT_LANGUAGE": 'en-US',
+    "AUDIO_CACHE_MAX_MB": 64,
 
     # Feature flags
     "REQUIRE_API_KEY": True,
     "REMOVE_FILTER": False,
     "EXPAND_API": True,
     "DETAILED_ERROR_LOGGING": True,
+    "AUDIO_CACHE": True,
 } 
\ No newline at end of file
@@ -1,8 +1,14 @@
 # handle_text.py
 
 import re
+import functools
 import emoji
 
+from utils import AUDIO_CACHE
+
+# Longer inputs bypass the cache since hashing them costs about as much as cleaning
+MAX_CACHED_INPUT_LENGTH = 4096
+
 def prepare_tts_input_with_context(text: str) -> str:
     """
     Prepares text for a TTS API by cleaning Markdown and adding minimal contextual hints
@@ -62,3 +68,19 @@ def prepare_tts_input_with_context(text: str) -> str:
     text = text.strip()
 
     return text
+
+_cached_prepare = functools.lru_cache(maxsize=2048)(prepare_tts_input_with_context)
+
+def prepare_tts_input_cached(text: str) -> str:
+    """
+    Memoized version of prepare_tts_input_with_context for recurring prompts.
+
+    Args:
+        text (str): The raw text containing Markdown or other formatting.
+
+    Returns:
+        str: Cleaned text with contextual hints suitable for TTS input.
+    """
+    if not AUDIO_CACHE or len(text) > MAX_CACHED_INPUT_LENGTH:
+        return prepare_tts_input_with_context(text)
+    return _cached_prepare(text)
@@ -1,15 +1,18 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, jsonify
 from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
 from dotenv import load_dotenv
 import os
 import traceback
+from lxml import etree
 
 from config import DEFAULT_CONFIGS
-from handle_text import prepare_tts_input_with_context
-from tts_handler import generate_speech, get_models, get_voices, voice_mapping
-from utils import getenv_bool, require_api_key, AUDIO_FORMAT_MIME_TYPES, DETAILED_ERROR_LOGGING
+from handle_text import prepare_tts_input_cached
+from tts_handler import stream_speech, get_models, get_voices, voice_mapping
+from utils import getenv_bool, require_api_key, OrjsonProvider, AUDIO_FORMAT_MIME_TYPES, DETAILED_ERROR_LOGGING
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 load_dotenv()
 
 API_KEY = os.getenv('API_KEY', DEFAULT_CONFIGS["API_KEY"])
@@ -22,6 +25,50 @@ DEFAULT_SPEED = float(os.getenv('DEFAULT_SPEED', str(DEFAULT_CONFIGS["DEFAULT_SP
 REMOVE_FILTER = getenv_bool('REMOVE_FILTER', DEFAULT_CONFIGS["REMOVE_FILTER"])
 EXPAND_API = getenv_bool('EXPAND_API', DEFAULT_CONFIGS["EXPAND_API"])
 
+# Synthesis and ffmpeg block their thread, so run them off the gevent hub
+tts_pool = ThreadPool(maxsize=(os.cpu_count() or 1) * 2)
+
+def run_in_pool(func, *args):
+    return tts_pool.spawn(func, *args).get()
+
+def _start_speech(text, voice, response_format, speed):
+    chunks = stream_speech(text, voice, response_format, speed)
+    # Pull the first chunk before responding so synthesis errors still return a 500
+    return chunks, next(chunks, b"")
+
+def speech_response(text, voice, response_format, speed, mime_type):
+    chunks, first_chunk = run_in_pool(_start_speech, text, voice, response_format, speed)
+
+    def generate():
+        try:
+            if first_chunk:
+                yield first_chunk
+            while True:
+                chunk = run_in_pool(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
+
+    return Response(
+        generate(),
+        mimetype=mime_type,
+        headers={"Content-Disposition": f"attachment; filename=speech.{response_format}"}
+    )
+
+SSML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+SSML_VOICE_XPATH = etree.XPath('//s:voice[1]', namespaces={'s': 'http://www.w3.org/2001/10/synthesis'})
+
+# voice_mapping is static, so the /v1/audio/voices payload only needs building once
+AUDIO_VOICES_RESPONSE = {
+    "object": "list",
+    "data": [
+        {"id": k, "name": v, "language": '-'.join(v.split('-')[:2])}
+        for k, v in voice_mapping.items()
+    ]
+}
+
 @app.route('/v1/audio/speech', methods=['POST'])
 @app.route('/audio/speech', methods=['POST'])  # Add this line for the alias
 @require_api_key
@@ -34,7 +81,7 @@ def text_to_speech():
         text = data.get('input')
 
         if not REMOVE_FILTER:
-            text = prepare_tts_input_with_context(text)
+            text = prepare_tts_input_cached(text)
 
         voice = data.get('voice', DEFAULT_VOICE)
         response_format = data.get('response_format', DEFAULT_RESPONSE_FORMAT)
@@ -42,8 +89,7 @@ def text_to_speech():
 
         mime_type = AUDIO_FORMAT_MIME_TYPES.get(response_format, "audio/mpeg")
 
-        output_file_path = generate_speech(text, voice, response_format, speed)
-        return send_file(output_file_path, mimetype=mime_type, as_attachment=True, download_name=f"speech.{response_format}")
+        return speech_response(text, voice, response_format, speed, mime_type)
     except Exception as e:
         if DETAILED_ERROR_LOGGING:
             app.logger.error(f"Error in text_to_speech: {str(e)}\n{traceback.format_exc()}")
@@ -65,13 +111,7 @@ def list_audio_models():
 @app.route('/v1/audio/voices', methods=['GET'])
 @require_api_key
 def list_audio_voices():
-    return jsonify({
-        "object": "list",
-        "data": [
-            {"id": k, "name": v, "language": v.split('-')[0] + '-' + v.split('-')[1]}
-            for k, v in voice_mapping.items()
-        ]
-    })
+    return jsonify(AUDIO_VOICES_RESPONSE)
 
 @app.route('/v1/models', methods=['GET', 'POST'])
 @app.route('/models', methods=['GET', 'POST'])
@@ -87,13 +127,13 @@ def list_voices():
     data = request.args if request.method == 'GET' else request.json
     if data and ('language' in data or 'locale' in data):
         specific_language = data.get('language') if 'language' in data else data.get('locale')
-    return jsonify({"voices": get_voices(specific_language)})
+    return jsonify({"voices": run_in_pool(get_voices, specific_language)})
 
 @app.route('/v1/voices/all', methods=['GET', 'POST'])
 @app.route('/voices/all', methods=['GET', 'POST'])
 @require_api_key
 def list_all_voices():
-    return jsonify({"voices": get_voices('all')})
+    return jsonify({"voices": run_in_pool(get_voices, 'all')})
 
 @app.route('/elevenlabs/v1/text-to-speech/<voice_id>', methods=['POST'])
 @require_api_key
@@ -110,19 +150,17 @@ def elevenlabs_tts(voice_id):
 
     text = payload['text']
     if not REMOVE_FILTER:
-        text = prepare_tts_input_with_context(text)
+        text = prepare_tts_input_cached(text)
 
     voice = voice_id
     response_format = 'mp3'
     speed = DEFAULT_SPEED
 
     try:
-        output_file_path = generate_speech(text, voice, response_format, speed)
+        return speech_response(text, voice, response_format, speed, "audio/mpeg")
     except Exception as e:
         return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
 
-    return send_file(output_file_path, mimetype="audio/mpeg", as_attachment=True, download_name="speech.mp3")
-
 @app.route('/azure/cognitiveservices/v1', methods=['POST'])
 @require_api_key
 def azure_tts():
@@ -134,28 +172,27 @@ def azure_tts():
         if not ssml_data:
             return jsonify({"error": "Missing SSML payload"}), 400
 
-        from xml.etree import ElementTree as ET
-        root = ET.fromstring(ssml_data)
-        text = root.find('.//{http://www.w3.org/2001/10/synthesis}voice').text
-        voice = root.find('.//{http://www.w3.org/2001/10/synthesis}voice').get('name')
+        root = etree.fromstring(request.data, SSML_PARSER)
+        voice_element = SSML_VOICE_XPATH(root)[0]
+        text = voice_element.text
+        voice = voice_element.get('name')
+        if not text:
+            raise ValueError("<voice> element has no text")
     except Exception as e:
         return jsonify({"error": f"Invalid SSML payload: {str(e)}"}), 400
 
     response_format = 'mp3'
     speed = DEFAULT_SPEED
     if not REMOVE_FILTER:
-        text = prepare_tts_input_with_context(text)
+        text = prepare_tts_input_cached(text)
 
     try:
-        app.logger.info(f"[TTS] Calling generate_speech() with voice={voice}, format={response_format}, speed={speed}")
-        output_file_path = generate_speech(text, voice, response_format, speed)
-        app.logger.info(f"[TTS] Speech generated at {output_file_path}")
+        app.logger.info(f"[TTS] Calling stream_speech() with voice={voice}, format={response_format}, speed={speed}")
+        return speech_response(text, voice, response_format, speed, "audio/mpeg")
     except Exception as e:
         app.logger.error(f"[TTS] Generation failed: {e}")
         return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
 
-    return send_file(output_file_path, mimetype="audio/mpeg", as_attachment=True, download_name="speech.mp3")
-
 print(f" Edge TTS (Free Azure TTS) Replacement for OpenAI's TTS API")
 print(f" * Server running on http://localhost:{PORT}")
 print(f" * TTS Endpoint: http://localhost:{PORT}/v1/audio/speech")
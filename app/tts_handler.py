@@ -1,20 +1,32 @@
 # tts_handler.py
 
 import edge_tts
+import aiohttp
 import asyncio
-import tempfile
+import collections
+import functools
+import hashlib
 import subprocess
 import os
-from pathlib import Path
+import queue
+import struct
+import threading
+import time
 
 from langdetect import detect, LangDetectException
 
-from utils import DETAILED_ERROR_LOGGING
+from utils import AUDIO_CACHE, DETAILED_ERROR_LOGGING
 from config import DEFAULT_CONFIGS
 
 # Language default (environment variable)
 DEFAULT_LANGUAGE = os.getenv('DEFAULT_LANGUAGE', DEFAULT_CONFIGS["DEFAULT_LANGUAGE"])
 
+# LRU cache of finished audio (disable with AUDIO_CACHE=False for privacy-sensitive deployments)
+AUDIO_CACHE_MAX_BYTES = int(float(os.getenv('AUDIO_CACHE_MAX_MB', str(DEFAULT_CONFIGS["AUDIO_CACHE_MAX_MB"]))) * 1024 * 1024)
+_audio_cache = collections.OrderedDict()
+_audio_cache_bytes = 0
+_audio_cache_lock = threading.Lock()
+
 # OpenAI voice names mapped to edge-tts equivalents
 voice_mapping = {
     'alloy': 'en-US-AvaNeural',
@@ -25,95 +37,299 @@ voice_mapping = {
     'shimmer': 'en-US-EmmaNeural'
 }
 
+def _is_english_only(voice):
+    return voice.startswith("en-") and "Multilingual" not in voice
+
+# OpenAI voice names whose edge-tts voice can't speak other languages
+ENGLISH_ONLY_VOICES = {k for k, v in voice_mapping.items() if _is_english_only(v)}
+
 # Language fallback voices
 MULTILINGUAL_VOICE = "en-US-AndrewMultilingualNeural"
 LANGUAGE_VOICE_OVERRIDES = {
     "ru": "ru-RU-DmitryNeural"
 }
+MIN_DETECT_LENGTH = 20
+
+# Detected language per input digest, most recently used last
+DETECT_CACHE_SIZE = 4096
+_detected_languages = collections.OrderedDict()
+_detected_languages_lock = threading.Lock()
+
+# Voice list cache, bucketed by locale ('all' holds the full list)
+VOICES_CACHE_TTL = 3600
+_voices_cache = None
+_voices_cache_time = 0.0
+_voices_lock = asyncio.Lock()
+
+# Persistent event loop that runs all edge-tts coroutines
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="edge-tts-loop", daemon=True).start()
+
+def _run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+class _SharedConnector(aiohttp.TCPConnector):
+    # edge-tts wraps the connector in a fresh ClientSession per call, which would
+    # close it on exit; keep it open so the DNS cache and idle connections survive
+    async def close(self, *, abort_ssl=False):
+        pass
+
+_connector = None
+
+def _get_connector():
+    # Must be called from a coroutine running on _loop
+    global _connector
+    if _connector is None:
+        _connector = _SharedConnector(limit=64, ttl_dns_cache=300, keepalive_timeout=75)
+    return _connector
+
+# edge-tts always streams audio-24khz-48kbitrate-mono-mp3; only this format skips ffmpeg
+EDGE_NATIVE_FORMAT = "mp3"
+
+# Pipe buffer size for streaming audio through ffmpeg
+FFMPEG_PIPE_BUFSIZE = 1 << 20
+
+# ffmpeg codec and container for each response format
+FFMPEG_CODECS = {
+    "aac": "aac",
+    "mp3": "libmp3lame",
+    "wav": "pcm_s16le",
+    "opus": "libopus",
+    "flac": "flac"
+}
+FFMPEG_CONTAINERS = {
+    "aac": "mp4",
+    "mp3": "mp3",
+    "wav": "wav",
+    "opus": "ogg",
+    "flac": "flac"
+}
+# wav's muxer only writes its chunk sizes to a seekable output, so through a pipe it is
+# buffered and its header patched before returning. flac streams as-is; piped STREAMINFO
+# leaves total samples, MD5 and frame sizes at 0, which the format defines as unknown.
+NEEDS_SEEKABLE_OUTPUT = {"wav"}
+FFMPEG_INPUT_ARGS = ("ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0")
+FFMPEG_OUTPUT_ARGS = ("pipe:1",)
+
+@functools.lru_cache(maxsize=32)
+def _build_ffmpeg_command(response_format):
+    output_format = FFMPEG_CONTAINERS.get(response_format, response_format)
+    args = ["-c:a", FFMPEG_CODECS.get(response_format, "aac")]
 
+    if response_format != "wav":
+        args.extend(["-b:a", "192k"])
+
+    if output_format == "mp4":
+        # The mp4 muxer needs a seekable output unless the moov atom is written up front
+        args.extend(["-movflags", "frag_keyframe+empty_moov"])
+
+    args.extend(["-f", output_format])
+    return FFMPEG_INPUT_ARGS + tuple(args) + FFMPEG_OUTPUT_ARGS
+
+@functools.lru_cache(maxsize=1)
 def is_ffmpeg_installed():
     try:
-        subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
         return False
 
-async def _generate_audio(text, voice, response_format, speed):
-    temp_mp3_file_obj = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-    temp_mp3_path = temp_mp3_file_obj.name
+async def _stream_audio(text, voice, speed):
+    if speed == 1.0:
+        speed_rate = "+0%"
+    else:
+        try:
+            speed_rate = speed_to_rate(speed)
+        except Exception as e:
+            print(f"Error converting speed: {e}. Defaulting to +0%.")
+            speed_rate = "+0%"
+
+    communicator = edge_tts.Communicate(text=text, voice=voice, rate=speed_rate, connector=_get_connector())
+    async for chunk in communicator.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
 
+async def _feed_queue(text, voice, speed, chunks):
     try:
-        speed_rate = speed_to_rate(speed)
+        async for data in _stream_audio(text, voice, speed):
+            chunks.put(data)
     except Exception as e:
-        print(f"Error converting speed: {e}. Defaulting to +0%.")
-        speed_rate = "+0%"
+        chunks.put(e)
+    finally:
+        chunks.put(None)
 
-    communicator = edge_tts.Communicate(text=text, voice=voice, rate=speed_rate)
-    await communicator.save(temp_mp3_path)
-    temp_mp3_file_obj.close()
+def _start_synthesis(text, voice, speed):
+    # Audio is produced on the shared event loop and handed over through a queue
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(_feed_queue(text, voice, speed, chunks), _loop)
+    return chunks, future
 
-    if response_format == "mp3":
-        return temp_mp3_path
+def _iter_mp3_chunks(chunks, future):
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        future.cancel()
 
-    if not is_ffmpeg_installed():
-        print("FFmpeg is not available. Returning unmodified mp3 file.")
-        return temp_mp3_path
-
-    converted_file_obj = tempfile.NamedTemporaryFile(delete=False, suffix=f".{response_format}")
-    converted_path = converted_file_obj.name
-    converted_file_obj.close()
-
-    ffmpeg_command = [
-        "ffmpeg", "-i", temp_mp3_path,
-        "-c:a", {
-            "aac": "aac",
-            "mp3": "libmp3lame",
-            "wav": "pcm_s16le",
-            "opus": "libopus",
-            "flac": "flac"
-        }.get(response_format, "aac")
-    ]
+def _ffmpeg_error(ffmpeg_command, returncode, stderr):
+    error_message = (
+        f"FFmpeg error during audio conversion. Command: '{' '.join(ffmpeg_command)}'. "
+        f"Stderr: {stderr.decode('utf-8', 'ignore')}" if DETAILED_ERROR_LOGGING
+        else f"FFmpeg error during audio conversion: exit status {returncode}"
+    )
+    print(error_message)
+    return RuntimeError(error_message)
 
-    if response_format != "wav":
-        ffmpeg_command.extend(["-b:a", "192k"])
-
-    ffmpeg_command.extend([
-        "-f", {
-            "aac": "mp4",
-            "mp3": "mp3",
-            "wav": "wav",
-            "opus": "ogg",
-            "flac": "flac"
-        }.get(response_format, response_format),
-        "-y", converted_path
-    ])
+def _transcode_chunks(mp3_chunks, synthesis, response_format):
+    ffmpeg_command = _build_ffmpeg_command(response_format)
+
+    process = subprocess.Popen(
+        ffmpeg_command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        # stderr is only read back for detailed error messages
+        stderr=subprocess.PIPE if DETAILED_ERROR_LOGGING else subprocess.DEVNULL,
+        bufsize=FFMPEG_PIPE_BUFSIZE
+    )
+    feed_errors = []
+
+    def feed_ffmpeg():
+        try:
+            for data in mp3_chunks:
+                process.stdin.write(data)
+                # Flush per chunk so ffmpeg can start encoding before synthesis ends
+                process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            mp3_chunks.close()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed_ffmpeg, daemon=True)
+    feeder.start()
 
     try:
-        subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        Path(converted_path).unlink(missing_ok=True)
-        Path(temp_mp3_path).unlink(missing_ok=True)
-
-        error_message = (
-            f"FFmpeg error during audio conversion. Command: '{' '.join(e.cmd)}'. "
-            f"Stderr: {e.stderr.decode('utf-8', 'ignore')}" if DETAILED_ERROR_LOGGING
-            else f"FFmpeg error during audio conversion: {e}"
-        )
-        print(error_message)
-        raise RuntimeError(error_message)
-
-    Path(temp_mp3_path).unlink(missing_ok=True)
-    return converted_path
-
-def generate_speech(text, voice, response_format, speed=1.0):
+        while True:
+            data = process.stdout.read1(FFMPEG_PIPE_BUFSIZE)
+            if not data:
+                break
+            yield data
+
+        feeder.join()
+        stderr = process.stderr.read() if process.stderr else b""
+        returncode = process.wait()
+        if feed_errors:
+            raise feed_errors[0]
+        if returncode != 0:
+            raise _ffmpeg_error(ffmpeg_command, returncode, stderr)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        # Stop synthesis too; the feeder thread then sees the end of the queue and exits
+        synthesis.cancel()
+        for pipe in (process.stdout, process.stderr):
+            if pipe:
+                pipe.close()
+
+def _patch_wav_header(wav):
+    # ffmpeg leaves the RIFF and data sizes as placeholders when writing to a pipe
+    struct.pack_into('<I', wav, 4, len(wav) - 8)
+    offset = 12
+    while offset + 8 <= len(wav):
+        chunk_id, size = struct.unpack_from('<4sI', wav, offset)
+        if chunk_id == b'data':
+            struct.pack_into('<I', wav, offset + 4, len(wav) - offset - 8)
+            break
+        offset += 8 + size + (size & 1)
+
+def _buffered_wav_chunks(mp3_chunks, synthesis):
+    try:
+        wav = bytearray()
+        for data in _transcode_chunks(mp3_chunks, synthesis, "wav"):
+            wav += data
+        _patch_wav_header(wav)
+        yield bytes(wav)
+    finally:
+        synthesis.cancel()
+
+def _detect_language(text):
+    # langdetect is unreliable on very short input, so treat it as English
+    if len(text) < MIN_DETECT_LENGTH:
+        return "en"
+
+    # Keyed by digest so the cache holds no user text and its size stays bounded
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _detected_languages_lock:
+        detected_lang = _detected_languages.get(key)
+        if detected_lang is not None:
+            _detected_languages.move_to_end(key)
+            return detected_lang
+
     try:
         detected_lang = detect(text)
     except LangDetectException:
         detected_lang = "en"
 
+    with _detected_languages_lock:
+        _detected_languages[key] = detected_lang
+        if len(_detected_languages) > DETECT_CACHE_SIZE:
+            _detected_languages.popitem(last=False)
+    return detected_lang
+
+def _audio_cache_key(text, voice, response_format, speed):
+    return hashlib.blake2b(repr((text, voice, response_format, speed)).encode('utf-8'), digest_size=16).digest()
+
+def _audio_cache_get(key):
+    with _audio_cache_lock:
+        audio = _audio_cache.get(key)
+        if audio is not None:
+            _audio_cache.move_to_end(key)
+        return audio
+
+def _audio_cache_put(key, audio):
+    global _audio_cache_bytes
+    if len(audio) > AUDIO_CACHE_MAX_BYTES:
+        return
+
+    with _audio_cache_lock:
+        if key in _audio_cache:
+            return
+        _audio_cache[key] = audio
+        _audio_cache_bytes += len(audio)
+        while _audio_cache_bytes > AUDIO_CACHE_MAX_BYTES:
+            _, evicted = _audio_cache.popitem(last=False)
+            _audio_cache_bytes -= len(evicted)
+
+def _iter_cached(audio):
+    yield audio
+
+def _cache_chunks(chunks, key):
+    # Only complete responses are cached; an interrupted stream is discarded
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+    _audio_cache_put(key, b"".join(parts))
+
+def _resolve_voice(text, voice):
     mapped_voice = voice_mapping.get(voice, voice)
 
-    if mapped_voice.startswith("en-") and "Multilingual" not in mapped_voice:
+    if voice in ENGLISH_ONLY_VOICES or (voice not in voice_mapping and _is_english_only(voice)):
+        detected_lang = _detect_language(text)
         if detected_lang in LANGUAGE_VOICE_OVERRIDES:
             print(f"[TTS] Detected {detected_lang} — using {LANGUAGE_VOICE_OVERRIDES[detected_lang]}")
             mapped_voice = LANGUAGE_VOICE_OVERRIDES[detected_lang]
@@ -121,7 +337,39 @@ def generate_speech(text, voice, response_format, speed=1.0):
             print(f"[TTS] Detected non-English ({detected_lang}) — using multilingual voice")
             mapped_voice = MULTILINGUAL_VOICE
 
-    return asyncio.run(_generate_audio(text, mapped_voice, response_format, speed))
+    return mapped_voice
+
+def stream_speech(text, voice, response_format, speed=1.0):
+    """
+    Synthesizes speech and returns a generator of audio chunks in the requested format.
+    Chunks are yielded as soon as edge-tts (and ffmpeg, when transcoding) produce them.
+    """
+    if not AUDIO_CACHE:
+        return _synthesize_chunks(text, voice, response_format, speed)
+
+    cache_key = _audio_cache_key(text, voice, response_format, speed)
+    audio = _audio_cache_get(cache_key)
+    if audio is not None:
+        return _iter_cached(audio)
+
+    return _cache_chunks(_synthesize_chunks(text, voice, response_format, speed), cache_key)
+
+def _synthesize_chunks(text, voice, response_format, speed):
+    mapped_voice = _resolve_voice(text, voice)
+    chunks, synthesis = _start_synthesis(text, mapped_voice, speed)
+    mp3_chunks = _iter_mp3_chunks(chunks, synthesis)
+
+    if response_format == EDGE_NATIVE_FORMAT:
+        return mp3_chunks
+
+    if not is_ffmpeg_installed():
+        print("FFmpeg is not available. Returning unmodified mp3 file.")
+        return mp3_chunks
+
+    if response_format in NEEDS_SEEKABLE_OUTPUT:
+        return _buffered_wav_chunks(mp3_chunks, synthesis)
+
+    return _transcode_chunks(mp3_chunks, synthesis, response_format)
 
 def get_models():
     return [
@@ -129,17 +377,34 @@ def get_models():
         {"id": "tts-1-hd", "name": "Text-to-speech v1 HD"}
     ]
 
+async def _load_voices():
+    global _voices_cache, _voices_cache_time
+
+    async with _voices_lock:
+        if _voices_cache is not None and time.monotonic() - _voices_cache_time < VOICES_CACHE_TTL:
+            return _voices_cache
+
+        all_voices = [
+            {"name": v['ShortName'], "gender": v['Gender'], "language": v['Locale']}
+            for v in await edge_tts.list_voices(connector=_get_connector())
+        ]
+        voices_by_locale = {'all': all_voices}
+        for v in all_voices:
+            voices_by_locale.setdefault(v['language'], []).append(v)
+
+        _voices_cache = voices_by_locale
+        _voices_cache_time = time.monotonic()
+        return _voices_cache
+
 async def _get_voices(language=None):
-    all_voices = await edge_tts.list_voices()
+    voices_by_locale = await _load_voices()
     language = language or DEFAULT_LANGUAGE
-    return [
-        {"name": v['ShortName'], "gender": v['Gender'], "language": v['Locale']}
-        for v in all_voices if language == 'all' or language is None or v['Locale'] == language
-    ]
+    return voices_by_locale.get(language, [])
 
 def get_voices(language=None):
-    return asyncio.run(_get_voices(language))
+    return _run_async(_get_voices(language))
 
+@functools.lru_cache(maxsize=64)
 def speed_to_rate(speed: float) -> str:
     if speed < 0 or speed > 2:
         raise ValueError("Speed must be between 0 and 2 (inclusive).")
@@ -1,8 +1,10 @@
 # utils.py
 
 from flask import request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from functools import wraps
 import os
+import orjson
 from dotenv import load_dotenv
 
 from config import DEFAULT_CONFIGS
@@ -18,6 +20,8 @@ def getenv_bool(name: str, default: bool = False) -> bool:
 API_KEY = os.getenv('API_KEY', DEFAULT_CONFIGS["API_KEY"])
 REQUIRE_API_KEY = getenv_bool('REQUIRE_API_KEY', DEFAULT_CONFIGS["REQUIRE_API_KEY"])
 DETAILED_ERROR_LOGGING = getenv_bool('DETAILED_ERROR_LOGGING', DEFAULT_CONFIGS["DETAILED_ERROR_LOGGING"])
+# Turns off every in-memory cache of user text or audio (for privacy-sensitive deployments)
+AUDIO_CACHE = getenv_bool('AUDIO_CACHE', DEFAULT_CONFIGS["AUDIO_CACHE"])
 
 def require_api_key(f):
     @wraps(f)
@@ -33,6 +37,23 @@ def require_api_key(f):
         return f(*args, **kwargs)
     return decorated_function
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes compact responses with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        # Pretty-printed (indented) output is left to the stdlib encoder
+        if "indent" in kwargs:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 # Mapping of audio format to MIME type
 AUDIO_FORMAT_MIME_TYPES = {
     "mp3": "audio/mpeg",